@@ -0,0 +1,188 @@
+#encoding=utf-8
+
+'''
+Streaming export of flight history as CSV or newline-delimited JSON, optionally gzipped.
+Flights are read and written in chunks, so memory use does not grow with the date range.
+
+    python -m airdelay.export --airport SVO --start 2013-08-01 --end 2013-09-01 --format ndjson --gzip > svo.json.gz
+'''
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import csv
+from datetime import datetime
+import io
+import json
+import sys
+import uuid
+import zlib
+
+from dateutil import parser as date_parser
+import redisco
+from redisco.models.utils import _encode_key
+
+from airdelay.models import Airport, Flight
+
+
+CSV = 'csv'
+NDJSON = 'ndjson'
+formats = CSV, NDJSON
+# an airport's export index outlives an abandoned export by this long, seconds
+INDEX_TIMEOUT = 3600
+
+
+def find_airport(iata_code):
+    airport = Airport.objects.filter(iata=iata_code).first()
+    if airport is None:
+        raise ValueError('Airport {} not found'.format(iata_code))
+    return airport
+
+
+def created_at_score(value):
+    '''Score of a datetime in the created_at index, as redisco stores it'''
+    return float(Flight._attributes['created_at'].typecast_for_storage(value))
+
+
+def airport_index_key(airport_id):
+    '''redisco's set of ids of the flights of an airport'''
+    return Flight._key['airport_id'][_encode_key(airport_id)]
+
+
+def load_flights(client, flight_ids, airports):
+    '''
+    Flights with all their attributes read in one round trip; redisco alone
+    would make one per attribute. airports caches Airports by id between calls.
+    '''
+    pipe = client.pipeline(transaction=False)
+    for flight_id in flight_ids:
+        pipe.hgetall(Flight._key[flight_id])
+    flights = []
+    for flight_id, values in zip(flight_ids, pipe.execute()):
+        if not values:
+            # deleted since the page was read
+            continue
+        flight = Flight()
+        flight.id = flight_id
+        for name, attribute in Flight._attributes.items():
+            value = values.get(name)
+            setattr(flight, name, None if value is None else attribute.typecast_for_read(value))
+        if flight.airport_id not in airports:
+            airports[flight.airport_id] = Airport.objects.get_by_id(flight.airport_id)
+        # what the airport reference would load on first access
+        flight._airport = airports[flight.airport_id]
+        flights.append(flight)
+    return flights
+
+
+def iter_flight_chunks(airport_id=None, start=None, end=None, chunk_size=1000):
+    '''
+    Yields lists of at most chunk_size Flights, oldest first. Pages are read
+    straight from the created_at sorted set, every one starting at the score the
+    previous one ended with, so a page costs the same however deep it is.
+    (redisco ignores filters and ordering next to a zfilter, hence the raw index.)
+    For one airport the index is first intersected with the airport's flights.
+    '''
+    client = redisco.get_client()
+    index = Flight._key['created_at']
+    if airport_id is not None:
+        index = 'export:' + uuid.uuid4().hex
+        client.zinterstore(index, {Flight._key['created_at']: 1, airport_index_key(airport_id): 0})
+    low = created_at_score(start) if start else '-inf'
+    high = created_at_score(end) if end else '+inf'
+    # flights with the score of low that were already exported
+    seen = set()
+    airports = {}
+    try:
+        while True:
+            pipe = client.pipeline(transaction=False)
+            pipe.zrangebyscore(index, low, high, start=0, num=chunk_size + len(seen), withscores=True)
+            if airport_id is not None:
+                pipe.expire(index, INDEX_TIMEOUT)
+            page = pipe.execute()[0]
+            page = [(flight_id, score) for flight_id, score in page if flight_id not in seen][:chunk_size]
+            chunk = load_flights(client, [flight_id for flight_id, _ in page], airports)
+            if chunk:
+                yield chunk
+            if len(page) < chunk_size:
+                break
+            last = page[-1][1]
+            seen = set(flight_id for flight_id, score in page if score == last) | (seen if last == low else set())
+            low = last
+    finally:
+        if airport_id is not None:
+            client.delete(index)
+
+
+def export_value(value):
+    if value is None or isinstance(value, (int, long, float)):
+        return value
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return unicode(value)
+
+
+def csv_lines(chunks):
+    fields = None
+    for chunk in chunks:
+        buffer_ = io.BytesIO()
+        writer = csv.writer(buffer_)
+        if fields is None:
+            fields = chunk[0].field_names
+            writer.writerow([f.encode('utf-8') for f in fields])
+        for flight in chunk:
+            writer.writerow([unicode('' if v is None else v).encode('utf-8')
+                             for v in map(export_value, flight.get_values(fields))])
+        yield buffer_.getvalue()
+
+
+def ndjson_lines(chunks):
+    fields = None
+    for chunk in chunks:
+        fields = fields or chunk[0].field_names
+        yield b''.join(
+            json.dumps(dict(zip(fields, map(export_value, flight.get_values(fields))))).encode('utf-8') + b'\n'
+            for flight in chunk
+        )
+
+
+def gzipped(blocks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for block in blocks:
+        compressed = compressor.compress(block)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export(iata_code=None, start=None, end=None, fmt=CSV, compress=False, chunk_size=1000):
+    '''Generator of byte strings forming the whole export, raises ValueError for bad arguments right away'''
+    if fmt not in formats:
+        raise ValueError('Unknown export format {}'.format(fmt))
+    airport_id = find_airport(iata_code).id if iata_code else None
+    chunks = iter_flight_chunks(airport_id, start, end, chunk_size)
+    blocks = csv_lines(chunks) if fmt == CSV else ndjson_lines(chunks)
+    return gzipped(blocks) if compress else blocks
+
+
+def main(args=None):
+    arguments = argparse.ArgumentParser(description='Export flight history')
+    arguments.add_argument('--airport', help='IATA code, all airports by default')
+    arguments.add_argument('--start', type=date_parser.parse, help='created at or after')
+    arguments.add_argument('--end', type=date_parser.parse, help='created at or before')
+    arguments.add_argument('--format', choices=formats, default=CSV)
+    arguments.add_argument('--gzip', action='store_true')
+    arguments.add_argument('--chunk-size', type=int, default=1000)
+    options = arguments.parse_args(args)
+
+    try:
+        blocks = export(options.airport, options.start, options.end, options.format, options.gzip,
+                        options.chunk_size)
+    except ValueError as e:
+        arguments.error(unicode(e))
+    for block in blocks:
+        sys.stdout.write(block)
+
+
+if __name__ == '__main__':
+    main()
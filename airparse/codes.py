@@ -1,15 +1,67 @@
 # encoding=utf-8
 
 import csv
-import redis
+import os
+
+from storage import get_connection
+from geo import GridIndex
+import snapshot
+
+
+SNAPSHOT_FILENAME = 'airports.snapshot'
+_snapshot = None
+_spatial_index = None
+# names found in Redis, they never change while the process runs
+_names = {}
+spatial_fields = 'iata_code', 'name', 'city', 'country'
 
 
 def find_airport_code(name):
+    airports = get_snapshot()
+    if airports is not None:
+        return airports.find_code(name)
     return get_cache().get(lk(name))
 
 
 def find_airport_name(code):
-    return get_cache().hget('airport:' + code, 'name')
+    airports = get_snapshot()
+    if airports is not None:
+        return airports.find_name(code)
+    if code not in _names:
+        name = get_cache().hget('airport:' + code, 'name')
+        if name is None:
+            return None
+        _names[code] = name
+    return _names[code]
+
+
+def get_snapshot():
+    '''Memory-mapped airports snapshot if one was built, None means lookups go to Redis'''
+    global _snapshot
+    if _snapshot is None and os.path.exists(SNAPSHOT_FILENAME):
+        _snapshot = snapshot.AirportsSnapshot(SNAPSHOT_FILENAME)
+    return _snapshot
+
+
+def get_spatial_index():
+    '''Grid of airports by coordinates, values are airport dicts as in the snapshot'''
+    global _spatial_index
+    if _spatial_index is None:
+        airports = get_snapshot() or load_airports()
+        _spatial_index = GridIndex(spatial_point(port) for port in airports
+                                   if port['iata_code'] and port['latitude'] != '' and port['longitude'] != '')
+    return _spatial_index
+
+
+def spatial_point(port):
+    lat, lon = float(port['latitude']), float(port['longitude'])
+    return lat, lon, dict({f: port[f] for f in spatial_fields}, latitude=lat, longitude=lon)
+
+
+def build_airports_snapshot(filename='airports.dat', target=SNAPSHOT_FILENAME):
+    global _snapshot
+    snapshot.build(load_airports(filename), target)
+    _snapshot = None
 
 
 def make_lookup_key(name):
@@ -17,10 +69,6 @@ def make_lookup_key(name):
 lk = make_lookup_key
 
 
-def get_connection():
-    return redis.StrictRedis()
-
-
 def is_cached(r):
     try:
         return int(r.get(lk('__cached')))
@@ -39,19 +87,24 @@ def get_cache():
 
 
 def cache_airports(r, airports):
-    for port in airports:
+    pipe = r.pipeline(transaction=False)
+    for i, port in enumerate(airports, 1):
         city_key = lk(port['city'])
         name_key = lk(port['name'])
-        r.set(city_key, port['iata_code'])
+        pipe.set(city_key, port['iata_code'])
         if city_key != name_key:
-            r.set(name_key, port['iata_code'])
+            pipe.set(name_key, port['iata_code'])
 
-        r.hmset('airport:' + port['iata_code'], port)
+        pipe.hmset('airport:' + port['iata_code'], port)
+        if not i % 1000:
+            pipe.execute()
+    pipe.execute()
 
 
 def reload_airports_cache():
     get_connection().set(lk('__cached'), 0)
     get_cache()
+    _names.clear()
 
 
 def load_airports(filename='airports.dat'):
@@ -1,25 +1,31 @@
 # encoding=utf-8
 
 from __future__ import print_function
+import calendar
 from datetime import datetime
+import hashlib
 import json
 from random import randint
 import sys
+import threading
 import time
 import traceback
 from functools import partial
-from urlparse import urlparse
+from urlparse import urlparse, urljoin
 
 from bs4 import BeautifulSoup
 from concurrent import futures
-import requests
-from requests_futures.sessions import FuturesSession
 import redis
+import requests
 
-from codes import find_airport_code, find_airport_name
-
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
-r = redis.StrictRedis()
+from codes import find_airport_code, find_airport_name
+from profiling import profiler
+from storage import get_connection, local_cache, INVALIDATION_CHANNEL, invalidation_message
 
 
 _agents = [
@@ -64,11 +70,44 @@ def flight_decoder(dct):
     return dct
 
 
+JSON = 'json'
+COLUMNAR = 'columnar'
+MSGPACK = 'msgpack'
+
+content_types = {
+    JSON: 'application/json',
+    COLUMNAR: 'application/vnd.airdelay.columnar+json',
+    MSGPACK: 'application/x-msgpack',
+}
+
+
+def available_formats():
+    return [fmt for fmt in content_types if fmt != MSGPACK or msgpack is not None]
+
+
+def to_epoch(value):
+    '''Airport local time as seconds since epoch, as if it was UTC, so it converts back unchanged'''
+    if value is None:
+        return None
+    if isinstance(value, basestring):
+        value = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+    return calendar.timegm(value.timetuple())
+
+
+def from_epoch(value):
+    return None if value is None else datetime.utcfromtimestamp(value)
+
+
+class AbsentField(object):
+    '''Marks a field missing from a Flight row; a class, so it stays the same object through pickle'''
+
+
 class Flight(dict):
     '''Enhanced dictionary for holding timetable entries'''
     fields = ['origin', 'origin_name', 'destination', 'destination_name', 'number', 'airline',
               'time_scheduled', 'time_actual', 'status', 'is_codeshare']
     time_fields = ['time_scheduled', 'time_actual']
+    string_table_fields = ['origin', 'origin_name', 'destination', 'destination_name', 'airline', 'status']
 
     def __init__(self, **kwargs):
         clean_data = self.clean(self._clean_kwargs(kwargs))
@@ -107,6 +146,14 @@ class Flight(dict):
             value = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
         return value
 
+    def to_row(self):
+        '''Compact tuple of field values, ordered as in Flight.fields, AbsentField for missing ones'''
+        return tuple(self.get(f, AbsentField) for f in self.fields)
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(**{f: v for f, v in zip(cls.fields, row) if v is not AbsentField})
+
 
 class Timetable(object):
     '''Holds Flights collection and a bit of metadata'''
@@ -115,6 +162,10 @@ class Timetable(object):
     time_retrieved = None
     cache_timeout = 180
     flights = None
+    stale = False
+    incomplete = False
+    saved = False
+    delay_threshold = 15
 
     def __init__(self, iata_code, *args, **kwargs):
         self.iata_code = iata_code
@@ -123,34 +174,168 @@ class Timetable(object):
         self.time_retrieved = datetime.now().replace(microsecond=0)
         super(Timetable, self).__init__(*args, **kwargs)
 
+    @staticmethod
+    def cache_key_for(iata_code):
+        return 'airport_cache:' + iata_code
+
     @property
     def _cache_key(self):
-        return 'airport_cache:' + self.iata_code
+        return self.cache_key_for(self.iata_code)
+
+    @property
+    def _last_good_key(self):
+        return 'airport_last_good:' + self.iata_code
 
     def is_in_cache(self):
-        return r.exists(self._cache_key)
+        return get_connection().exists(self._cache_key)
 
     def get_raw_from_cache(self):
-        return r.get(self._cache_key)
+        '''Local copy first, Redis second; a copy from Redis is kept locally until its Redis TTL'''
+        raw = local_cache.get((self.iata_code, JSON))
+        if raw is None:
+            pipe = get_connection().pipeline(transaction=False)
+            pipe.get(self._cache_key)
+            pipe.ttl(self._cache_key)
+            raw, ttl = pipe.execute()
+            if raw is not None:
+                local_cache.set((self.iata_code, JSON), raw, ttl)
+        return raw
 
     def load_from_cache(self):
         cached_timetable = self.get_raw_from_cache()
         return self.set_from_json(cached_timetable)
 
     def save_to_cache(self):
-        if self.is_in_cache():
-            return
-        r.set(self._cache_key, self.to_json())
-        r.expire(self._cache_key, self.cache_timeout)
+        # an entry saved meanwhile by another worker is kept, and only the refresh
+        # that got into the cache counts for the refresh policy
+        raw = self.to_json()
+        timeout = refresh_policy.store(self.iata_code, self._cache_key, raw, self.flights)
+        pipe = get_connection().pipeline()
+        pipe.set(self._last_good_key, raw)
+        if timeout:
+            pipe.publish(INVALIDATION_CHANNEL, invalidation_message(self.iata_code))
+        pipe.execute()
+        if timeout:
+            # only a copy that went into Redis may be kept locally
+            self.cache_timeout = timeout
+            self.saved = True
+            local_cache.invalidate(self.iata_code)
+            local_cache.set((self.iata_code, JSON), raw, timeout)
+        return self.saved
+
+    def load_last_good(self):
+        '''Falls back to the last complete timetable, which never expires'''
+        if not self.set_from_json(get_connection().get(self._last_good_key)):
+            return False
+        self.stale = True
+        return True
 
     def to_dict(self):
         return {
             'iata_code': self.iata_code,
             'name': self.name,
             'time_retrieved': self.time_retrieved,
+            'stale': self.stale,
+            'incomplete': self.incomplete,
             'flights': self.flights
         }
 
+    def delay_summary(self):
+        '''Counts of delayed and cancelled flights, delays in minutes'''
+        delays = []
+        delayed = cancelled = 0
+        for flight in self.flights:
+            delay = None
+            if isinstance(flight.time_actual, datetime) and isinstance(flight.time_scheduled, datetime):
+                delay = (flight.time_actual - flight.time_scheduled).total_seconds() / 60
+            is_late = delay is not None and delay >= self.delay_threshold
+            if is_late:
+                delays.append(delay)
+            if flight.status == FlightStatus.CANCELLED:
+                cancelled += 1
+            elif flight.status == FlightStatus.DELAYED or is_late:
+                delayed += 1
+        return {
+            'flights': len(self.flights),
+            'delayed': delayed,
+            'cancelled': cancelled,
+            'average_delay_minutes': round(sum(delays) / len(delays), 1) if delays else 0,
+            'max_delay_minutes': max(delays) if delays else 0,
+        }
+
+    def to_columnar(self):
+        '''
+        Column per Flight field instead of a dict per Flight. Airport, airline
+        and status columns hold indices into the shared "strings" table,
+        time columns hold epoch integers (see to_epoch).
+        '''
+        strings, string_index = [], {}
+
+        def string_ref(value):
+            if value is None:
+                return None
+            if value not in string_index:
+                string_index[value] = len(strings)
+                strings.append(value)
+            return string_index[value]
+
+        columns = {}
+        for field in Flight.fields:
+            values = [flight.get(field) for flight in self.flights]
+            if field in Flight.string_table_fields:
+                values = map(string_ref, values)
+            elif field in Flight.time_fields:
+                values = map(to_epoch, values)
+            columns[field] = values
+
+        return {
+            'iata_code': self.iata_code,
+            'name': self.name,
+            'time_retrieved': to_epoch(self.time_retrieved),
+            'stale': self.stale,
+            'incomplete': self.incomplete,
+            'strings': strings,
+            'columns': columns,
+        }
+
+    def set_from_columnar(self, data):
+        try:
+            strings, columns = data['strings'], data['columns']
+            rows = []
+            for field in Flight.fields:
+                values = columns[field]
+                if field in Flight.string_table_fields:
+                    values = [None if i is None else strings[i] for i in values]
+                elif field in Flight.time_fields:
+                    values = map(from_epoch, values)
+                rows.append(values)
+            self.flights = map(Flight.from_row, zip(*rows))
+            self.time_retrieved = from_epoch(data['time_retrieved'])
+        except (ValueError, TypeError, KeyError, IndexError):
+            return False
+        return True
+
+    def encode(self, fmt=JSON):
+        if fmt == COLUMNAR:
+            return json.dumps(self.to_columnar())
+        if fmt == MSGPACK:
+            # without use_bin_type str and unicode both go out as msgpack strings
+            return msgpack.packb(self.to_columnar())
+        return self.to_json()
+
+    def decode(self, raw, fmt=JSON):
+        if fmt == COLUMNAR:
+            try:
+                return self.set_from_columnar(json.loads(raw))
+            except ValueError:
+                return False
+        if fmt == MSGPACK:
+            try:
+                return self.set_from_columnar(msgpack.unpackb(raw, encoding='utf-8'))
+            except (ValueError, msgpack.exceptions.UnpackException):
+                return False
+        return self.set_from_json(raw)
+
     def set_from_json(self, raw):
         try:
             loaded_timetable = self.from_json(raw)
@@ -172,6 +357,69 @@ class Timetable(object):
         return self
 
 
+class RefreshPolicy(object):
+    '''
+    Adapts cache timeout of every airport to how often its timetable actually
+    changes, separately for every hour of the day. A refresh bringing the same
+    flights stretches the timeout for that hour, a changed one shrinks it.
+    State lives in Redis, so all workers learn together.
+    '''
+    def __init__(self, default=Timetable.cache_timeout, min_timeout=60, max_timeout=900,
+                 growth=1.5, shrink=0.5):
+        self.default = default
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.growth = growth
+        self.shrink = shrink
+
+    @staticmethod
+    def _key(iata_code):
+        return 'airport_refresh:' + iata_code
+
+    @staticmethod
+    def digest(flights):
+        encoded = sorted(json.dumps(f, cls=FlightEncoder, sort_keys=True) for f in flights)
+        return hashlib.sha1(''.join(encoded)).hexdigest()
+
+    def clamp(self, timeout):
+        return int(min(max(timeout, self.min_timeout), self.max_timeout))
+
+    def store(self, iata_code, cache_key, raw, flights, hour=None):
+        '''
+        Saves raw under cache_key unless another worker got there first, and records
+        the refresh in the same transaction. Returns the new cache timeout, None when
+        the cache already held a timetable and nothing was changed.
+        '''
+        hour = datetime.now().hour if hour is None else hour
+        # empty flights mean nothing was parsed, that says nothing about the change rate
+        digest = self.digest(flights) if flights else None
+        key = self._key(iata_code)
+        with get_connection().pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(cache_key, key)
+                    if pipe.exists(cache_key):
+                        return None
+                    last_digest, timeout = pipe.hmget(key, 'digest', hour)
+                    timeout = float(timeout) if timeout else self.default
+                    if digest and last_digest is not None:
+                        timeout *= self.growth if digest == last_digest else self.shrink
+                    timeout = self.clamp(timeout)
+
+                    pipe.multi()
+                    pipe.setex(cache_key, timeout, raw)
+                    if digest:
+                        pipe.hmset(key, {'digest': digest, hour: timeout})
+                    pipe.execute()
+                    return timeout
+                except redis.WatchError:
+                    # someone saved the airport meanwhile, look again
+                    continue
+
+
+refresh_policy = RefreshPolicy()
+
+
 class Throttler(object):
     def __init__(self, delay=2):
         self.delay = delay
@@ -208,6 +456,82 @@ class Throttler(object):
 throttle_requests = Throttler()
 
 
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    '''
+    Counts consecutive failed fetches per domain. After `threshold` of them
+    the domain is skipped for `reset_timeout` seconds, then one fetch is let
+    through to probe it again.
+    '''
+    def __init__(self, threshold=3, reset_timeout=60):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = {}
+        self.opened_at = {}
+        self.lock = threading.Lock()
+
+    def get_domain(self, url):
+        return urlparse(url).netloc
+
+    def check(self, url):
+        domain = self.get_domain(url)
+        with self.lock:
+            opened_at = self.opened_at.get(domain)
+            if opened_at is None:
+                return
+            if time.time() - opened_at < self.reset_timeout:
+                raise CircuitOpen('{} is failing, not fetching {}'.format(domain, url))
+            # half-open: this caller probes the domain, others keep failing fast
+            self.opened_at[domain] = time.time()
+
+    def record_success(self, url):
+        domain = self.get_domain(url)
+        with self.lock:
+            self.failures.pop(domain, None)
+            self.opened_at.pop(domain, None)
+
+    def record_failure(self, url):
+        domain = self.get_domain(url)
+        with self.lock:
+            self.failures[domain] = self.failures.get(domain, 0) + 1
+            if self.failures[domain] >= self.threshold:
+                self.opened_at[domain] = time.time()
+
+
+circuit_breaker = CircuitBreaker()
+
+
+_retrieval_executor = futures.ThreadPoolExecutor(max_workers=8)
+_hedge_executor = futures.ThreadPoolExecutor(max_workers=8)
+_process_pool = None
+_worker_parsers = {}
+
+
+def configure_parsing_processes(max_workers):
+    '''Moves HTML parsing to a pool of worker processes, 0 keeps it in threads'''
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False)
+        _process_pool = None
+    if max_workers:
+        _process_pool = futures.ProcessPoolExecutor(max_workers=max_workers)
+        # the first submit starts all the workers, so they are warm before any cache miss
+        _process_pool.submit(len, ()).result()
+
+
+def parse_in_process(parser_class, iata_code, html, url, defaults):
+    '''Runs in a worker process: parses raw HTML, returns Flights as compact rows and next page URL'''
+    key = parser_class, iata_code
+    if key not in _worker_parsers:
+        _worker_parsers[key] = parser_class(iata_code)
+    parser = _worker_parsers[key]
+    soup = parser.parse_html(html)
+    return [f.to_row() for f in parser.parse(soup, **defaults)], parser.find_next_page(soup, url)
+
+
 class BaseParser(object):
     '''
     Base class for all parsers containing asynchronous running methods.
@@ -215,11 +539,23 @@ class BaseParser(object):
     def parse(self, **defaults)
         ...
         yield Flight(...)
+    Paginated timetables may also define next_page(self, soup, url)
+    returning the URL of the following page or None.
+
+    fetch_timeout limits every request to the site, deadline limits the whole
+    refresh counting from run_async; past it the refresh is abandoned and marked
+    as incomplete, and the last good timetable is served marked as stale.
+    With hedge_after set, a request still running after that many seconds
+    gets a twin, and whichever succeeds first wins.
     '''
     iata_code = None
     name = None
     urls = None
     client = None
+    max_pages = 10
+    fetch_timeout = 10
+    deadline = 30
+    hedge_after = None
     request_headers = {
         'Accept-Language': 'en-US',
     }
@@ -237,6 +573,10 @@ class BaseParser(object):
         }
 
         self.request_headers['User-Agent'] = _agents[randint(0, len(_agents) - 1)]
+        self.profiled = profiler.should_profile(iata_code)
+        # crawling threads add to records only under the lock and until abandoned
+        self.lock = threading.Lock()
+        self.abandoned = False
 
     def get_request_headers(self):
         return self.request_headers
@@ -246,69 +586,164 @@ class BaseParser(object):
 
     # @throttle_requests
     def fetch_url(self, url):
-        return requests.get(url, headers=self.get_request_headers())
-
-    def parse_html(self, response):
+        circuit_breaker.check(url)
+        try:
+            response = self.hedged_get(url) if self.hedge_after else self.get_url(url)
+            response.raise_for_status()
+        except Exception:
+            circuit_breaker.record_failure(url)
+            raise
+        circuit_breaker.record_success(url)
+        return response
+
+    def get_url(self, url):
+        return requests.get(url, headers=self.get_request_headers(), timeout=self.fetch_timeout)
+
+    def hedged_get(self, url):
+        get_url = partial(profiler.profile, self.iata_code, 'run_async', self.get_url) if self.profiled \
+            else self.get_url
+        attempts = [_hedge_executor.submit(get_url, url)]
+        done, _ = futures.wait(attempts, timeout=self.hedge_after)
+        if not done:
+            attempts.append(_hedge_executor.submit(get_url, url))
+        error = None
+        for attempt in futures.as_completed(attempts):
+            error = attempt.exception()
+            if error is None:
+                return attempt.result()
+        raise error
+
+    def get_html(self, response):
         # Tornado Async client or Requests or just plain html
         if isinstance(response, basestring):
-            html = response
-        else:
-            html = getattr(response, 'body', response.content)
-        return BeautifulSoup(html)
+            return response
+        return getattr(response, 'body', response.content)
 
-    def parse_async(self, content, **defaults):
+    def parse_html(self, response):
+        return BeautifulSoup(self.get_html(response))
+
+    def next_page(self, soup, url):
+        return None
+
+    def find_next_page(self, soup, url):
+        next_url = self.next_page(soup, url)
+        return urljoin(url, next_url) if next_url else None
+
+    def parse_content(self, content, url=None, **defaults):
+        '''Returns parsed Flights and the next page URL, if there is one'''
+        def parse_page():
+            soup = self.parse_html(content)
+            return list(self.parse(soup, **defaults)), self.find_next_page(soup, url)
+
+        # profiled pages are parsed here, the profiler does not see other processes
+        if self.profiled:
+            return profiler.profile(self.iata_code, 'parse', parse_page)
+        if _process_pool is None:
+            return parse_page()
+        rows, next_url = _process_pool.submit(parse_in_process, type(self), self.iata_code,
+                                              self.get_html(content), url, defaults).result()
+        return map(Flight.from_row, rows), next_url
+
+    def crawl(self, url, on_page=None, **defaults):
+        '''Fetches and parses pages one by one, following pagination'''
+        for _ in range(self.max_pages):
+            if self.abandoned:
+                break
+            flights, url = self.parse_content(self.fetch_url(url), url, **defaults)
+            with self.lock:
+                if self.abandoned:
+                    # the deadline has passed, records are already handed out
+                    break
+                self.records += flights
+                if on_page:
+                    on_page(flights)
+            if not url:
+                break
+
+    def crawl_async(self, url, on_page=None, **defaults):
         try:
-            self.records += list(self.parse(self.parse_html(content), **defaults))
+            self.crawl(url, on_page, **defaults)
+        except CircuitOpen as e:
+            print(e)
+            return False
         except:
             print('error while parsing {}:\n'.format(self.iata_code))
             traceback.print_exception(*sys.exc_info())
+            return False
+        return True
 
     def run(self):
         if self.records.load_from_cache():
             return self.records
 
-        for type_, urls in self.urls.items():
-            for results in map(lambda url: list(self.parse(self.parse_html(self.fetch_url(url)), type=type_)), urls):
-                self.records += results
+        try:
+            for type_, urls in self.urls.items():
+                for url in urls:
+                    self.crawl(url, type=type_)
+        except Exception:
+            self.records.incomplete = True
+            if self.records.load_last_good():
+                return self.records
+            raise
 
         # self.set_status('OK')
         self.records.save_to_cache()
         return self.records
 
-    def get_async_parsers(self):
-        fetchers = {}
-        with futures.ThreadPoolExecutor(max_workers=6) as executor:
-            session = FuturesSession(executor)
-            session.headers.update(self.get_request_headers())
-            # getter = partial(session.request, 'get',
-            #                  background_callback=lambda s, r: self.parse_html(r))
-
-            for type_, urls in self.urls.items():
-                fetchers.update(map(lambda url: (executor.submit(self.fetch_url, url), type_), urls))
-
-            parsers = [executor.submit(self.parse_async, fetcher.result(), type=fetchers[fetcher])
-                       for fetcher in futures.as_completed(fetchers)]
+    def get_async_parsers(self, on_page=None):
+        executor = futures.ThreadPoolExecutor(max_workers=6)
+        # the refresh work happens in these threads, so that is where run_async is profiled
+        crawl = partial(profiler.profile, self.iata_code, 'run_async', self.crawl_async) if self.profiled \
+            else self.crawl_async
+        parsers = [executor.submit(crawl, url, on_page, type=type_)
+                   for type_, urls in self.urls.items() for url in urls]
+        # threads finish on their own, bounded by fetch_timeout and max_pages
+        executor.shutdown(wait=False)
         return parsers
 
-    def get_async_results(self, retrievers=None):
-        """Waits while data retrieval futures finish their job or returns records right away"""
-        if retrievers:
-            futures.wait(retrievers)
+    def abandon(self):
+        '''Stops crawling threads from changing records, falls back to the last good timetable'''
+        with self.lock:
+            self.abandoned = True
+        self.records.incomplete = True
+        if not self.records.load_last_good():
+            print('incomplete results for {}, no last good timetable'.format(self.iata_code))
+
+    def get_async_results(self, retrievers=None, deadline=None):
+        """
+        Waits while data retrieval futures finish their job or returns records right away.
+        Caches complete results; if the deadline (a time.time() value, self.deadline
+        seconds from now by default) passes or a page fails, abandons the refresh.
+        """
+        if not retrievers:
+            return self.records
+        timeout = self.deadline if deadline is None else max(deadline - time.time(), 0)
+        done, not_done = futures.wait(retrievers, timeout=timeout)
+        if not not_done and all(f.result() for f in done):
+            self.records.save_to_cache()
+        else:
+            self.abandon()
         return self.records
 
-    def run_async(self):
+    def run_async(self, on_page=None):
+        '''
+        Returns a future resolving to the Timetable.
+        on_page, if given, is called from worker threads with the Flights of
+        every page as soon as it is parsed; it is not called on cache hits.
+        '''
+        # time spent waiting for a free retrieval thread counts towards the deadline
+        deadline = time.time() + self.deadline
+
         def results_retrieval():
-            with futures.ThreadPoolExecutor(max_workers=2) as executor:
-                cache_hit = executor.submit(self.records.load_from_cache)
-                if not cache_hit.result():
-                    future_results = executor.submit(self.get_async_results, self.get_async_parsers())
-                    future_results.add_done_callback(lambda f: self.records.save_to_cache())
-                    return future_results.result()
-                else:
-                    return self.get_async_results()
-
-        with futures.ThreadPoolExecutor(max_workers=1) as executor:
-            return executor.submit(results_retrieval)
+            if self.records.load_from_cache():
+                return self.records
+            if time.time() >= deadline:
+                self.abandon()
+                return self.records
+            return self.get_async_results(self.get_async_parsers(on_page), deadline)
+
+        # a shared executor: leaving a `with` block here would wait for the result
+        return _retrieval_executor.submit(results_retrieval)
 
     def parse(self, content, **defaults):
         raise NotImplementedError
\ No newline at end of file
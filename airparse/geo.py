@@ -0,0 +1,82 @@
+# encoding=utf-8
+
+from math import radians, sin, cos, asin, sqrt, floor
+
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.195
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    '''Great-circle distance by haversine formula'''
+    lat1, lon1, lat2, lon2 = map(radians, (lat1, lon1, lat2, lon2))
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * asin(min(1, sqrt(a)))
+
+
+class GridIndex(object):
+    '''
+    Points bucketed into cells of cell_size degrees, so a radius query only
+    looks at the cells around the point instead of every point.
+    '''
+    def __init__(self, points=(), cell_size=1.0):
+        self.cell_size = cell_size
+        self.lat_cells = int(round(180 / cell_size))
+        self.lon_cells = int(round(360 / cell_size))
+        self.cells = {}
+        self.count = 0
+        for lat, lon, value in points:
+            self.add(lat, lon, value)
+
+    def _lat_cell(self, lat):
+        return min(max(int(floor((lat + 90) / self.cell_size)), 0), self.lat_cells - 1)
+
+    def _lon_cell(self, lon):
+        return int(floor((lon + 180) / self.cell_size)) % self.lon_cells
+
+    def add(self, lat, lon, value):
+        self.cells.setdefault((self._lat_cell(lat), self._lon_cell(lon)), []).append((lat, lon, value))
+        self.count += 1
+
+    def _cells_around(self, lat, lon, km):
+        lat_span = km / KM_PER_DEGREE
+        lat_range = range(self._lat_cell(lat - lat_span), self._lat_cell(lat + lat_span) + 1)
+
+        # a degree of longitude is shortest at the latitude farthest from the equator
+        widest_lat = min(abs(lat) + lat_span, 90)
+        lon_degree_km = KM_PER_DEGREE * cos(radians(widest_lat))
+        if lon_degree_km <= 0 or km / lon_degree_km >= 180:
+            lon_range = range(self.lon_cells)
+        else:
+            lon_span = km / lon_degree_km
+            first, last = self._lon_cell(lon - lon_span), self._lon_cell(lon + lon_span)
+            if last < first:
+                last += self.lon_cells
+            lon_range = [cell % self.lon_cells for cell in range(first, last + 1)]
+
+        for lat_cell in lat_range:
+            for lon_cell in lon_range:
+                for point in self.cells.get((lat_cell, lon_cell), ()):
+                    yield point
+
+    def within(self, lat, lon, km):
+        '''(distance, value) pairs of points no farther than km, closest first'''
+        found = []
+        for point_lat, point_lon, value in self._cells_around(lat, lon, km):
+            distance = distance_km(lat, lon, point_lat, point_lon)
+            if distance <= km:
+                found.append((distance, value))
+        found.sort(key=lambda item: item[0])
+        return found
+
+    def nearest(self, lat, lon, start_km=50):
+        '''(distance, value) of the closest point, None for an empty index'''
+        km = start_km
+        while self.count:
+            found = self.within(lat, lon, km)
+            if found:
+                return found[0]
+            if km > EARTH_RADIUS_KM * 3.15:
+                break
+            km *= 2
+        return None
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# encoding=utf-8
+
+'''
+Load test for tornado_runner.app against local stand-ins of airport websites and Redis.
+
+    python airparse/loadtest.py record
+        saves current DME, SVO, VKO and LED boards (all pages) to --fixtures,
+        needs the real websites and Redis
+    python airparse/loadtest.py run --scenarios=hit,miss,mixed,storm --concurrency=20
+        starts a throwaway redis-server, a fake upstream replaying the recorded
+        boards with --latency seconds of delay and airparse.tornado_runner using both,
+        then reports throughput and latency percentiles for every scenario
+
+The fake upstream works as an HTTP proxy for airparse.tornado_runner, so parsers
+fetch their usual URLs. Run from the repository root, where airports.dat lives.
+'''
+
+from __future__ import print_function
+
+from hashlib import sha1
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import tornado.gen
+import tornado.httpclient
+import tornado.httpserver
+import tornado.ioloop
+import tornado.options
+import tornado.web
+from tornado.options import define, options
+
+from parsers import registry
+from engine import Timetable
+import codes
+import storage
+
+
+define("fixtures", default=os.path.join(os.path.dirname(__file__), 'loadtest_fixtures'),
+       help="directory with recorded airport boards", type=str)
+define("app_port", default=8100, help="port of the tested airparse.tornado_runner", type=int)
+define("parse_processes", default=0, help="passed to airparse.tornado_runner", type=int)
+define("upstream_port", default=8101, help="port of the fake airport websites", type=int)
+define("latency", default=0.5, help="mean delay of the fake airport websites, seconds", type=float)
+define("latency_jitter", default=0.25, help="random deviation of the delay, seconds", type=float)
+define("redis_server", default='redis-server', help="redis-server executable for the Redis stand-in", type=str)
+define("stand_in_redis_port", default=6399, help="port of the Redis stand-in", type=int)
+define("scenarios", default='hit,miss,mixed,storm', help="comma separated scenarios to run", type=str)
+define("requests_count", default=500, help="requests per scenario", type=int)
+define("concurrency", default=20, help="requests in flight at once", type=int)
+define("miss_ratio", default=0.2, help="share of cache misses in the mixed scenario", type=float)
+define("storm_rounds", default=5, help="cache flushes in the expiry storm scenario", type=int)
+project_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def fixture_filename(url):
+    return sha1(url).hexdigest() + '.html'
+
+
+def fixtures_index():
+    return os.path.join(options.fixtures, 'index.json')
+
+
+def check_fixtures():
+    '''Recorded boards are not shipped, they have to be recorded first'''
+    if not os.path.exists(fixtures_index()):
+        sys.exit('No recorded boards in {}, run "python airparse/loadtest.py record" first '
+                 'or point --fixtures to a recorded set'.format(options.fixtures))
+
+
+def record():
+    '''Saves every page of every registered airport board, following pagination'''
+    if not os.path.isdir(options.fixtures):
+        os.makedirs(options.fixtures)
+    index = {}
+    for iata_code in sorted(registry):
+        parser = registry.initialize(iata_code)
+        for urls in parser.urls.values():
+            for url in urls:
+                for _ in range(parser.max_pages):
+                    response = parser.fetch_url(url)
+                    with open(os.path.join(options.fixtures, fixture_filename(url)), 'wb') as fixture:
+                        fixture.write(response.content)
+                    index[url] = fixture_filename(url)
+                    print('recorded', url)
+                    url = parser.find_next_page(parser.parse_html(response), url)
+                    if not url:
+                        break
+    with open(fixtures_index(), 'w') as index_file:
+        json.dump(index, index_file, indent=2)
+
+
+class UpstreamHandler(tornado.web.RequestHandler):
+    '''Proxy requests carry the full URL, the recorded page for it is replayed after a delay'''
+    def initialize(self, index):
+        self.index = index
+
+    @tornado.gen.coroutine
+    def get(self):
+        delay = max(0, random.uniform(options.latency - options.latency_jitter,
+                                      options.latency + options.latency_jitter))
+        ioloop = tornado.ioloop.IOLoop.instance()
+        yield tornado.gen.Task(ioloop.add_timeout, time.time() + delay)
+
+        if self.request.uri not in self.index:
+            raise tornado.web.HTTPError(404)
+        with open(os.path.join(options.fixtures, self.index[self.request.uri]), 'rb') as fixture:
+            self.write(fixture.read())
+
+
+def upstream():
+    check_fixtures()
+    with open(fixtures_index()) as index_file:
+        index = json.load(index_file)
+    application = tornado.web.Application([(r'.*', UpstreamHandler, {'index': index})])
+    tornado.httpserver.HTTPServer(application).listen(options.upstream_port, '127.0.0.1')
+    tornado.ioloop.IOLoop.instance().start()
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('nothing listens on port {}'.format(port))
+
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[int(round(percent / 100.0 * (len(ordered) - 1)))]
+
+
+class LoadGenerator(object):
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        tornado.httpclient.AsyncHTTPClient.configure(None, max_clients=concurrency)
+        self.client = tornado.httpclient.AsyncHTTPClient()
+
+    def url(self, iata_code):
+        return 'http://127.0.0.1:{}/airports/{}/'.format(options.app_port, iata_code)
+
+    def expire(self, iata_codes):
+        storage.get_connection().delete(*[Timetable.cache_key_for(code) for code in iata_codes])
+        for iata_code in iata_codes:
+            storage.publish_invalidation(iata_code)
+
+    @tornado.gen.coroutine
+    def fire(self, iata_codes, miss_ratio=0):
+        '''Requests all iata_codes, concurrency at a time; returns latencies and error count'''
+        queue = list(iata_codes)
+        latencies, errors = [], [0]
+
+        @tornado.gen.coroutine
+        def worker():
+            while queue:
+                iata_code = queue.pop()
+                if miss_ratio and random.random() < miss_ratio:
+                    self.expire([iata_code])
+                started = time.time()
+                try:
+                    yield self.client.fetch(self.url(iata_code), request_timeout=120)
+                except tornado.httpclient.HTTPError:
+                    errors[0] += 1
+                latencies.append(time.time() - started)
+
+        yield [worker() for _ in range(self.concurrency)]
+        raise tornado.gen.Return((latencies, errors[0]))
+
+    def random_codes(self, count):
+        airports = sorted(registry)
+        return [random.choice(airports) for _ in range(count)]
+
+    @tornado.gen.coroutine
+    def warm_up(self):
+        yield self.fire(sorted(registry))
+
+    @tornado.gen.coroutine
+    def hit(self):
+        yield self.warm_up()
+        result = yield self.fire(self.random_codes(options.requests_count))
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def miss(self):
+        result = yield self.fire(self.random_codes(options.requests_count), miss_ratio=1)
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def mixed(self):
+        yield self.warm_up()
+        result = yield self.fire(self.random_codes(options.requests_count), miss_ratio=options.miss_ratio)
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def storm(self):
+        '''Every airport expires at once while concurrency clients keep asking'''
+        latencies, errors = [], 0
+        per_round = max(options.requests_count // options.storm_rounds, self.concurrency)
+        for _ in range(options.storm_rounds):
+            yield self.warm_up()
+            self.expire(sorted(registry))
+            round_latencies, round_errors = yield self.fire(self.random_codes(per_round))
+            latencies.extend(round_latencies)
+            errors += round_errors
+        raise tornado.gen.Return((latencies, errors))
+
+
+@tornado.gen.coroutine
+def run_scenarios():
+    generator = LoadGenerator(options.concurrency)
+    print('{:<10}{:>10}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}'.format(
+        'scenario', 'requests', 'errors', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    for scenario in options.scenarios.split(','):
+        started = time.time()
+        latencies, errors = yield getattr(generator, scenario)()
+        elapsed = time.time() - started
+        print('{:<10}{:>10}{:>8}{:>10.1f}{:>10.0f}{:>10.0f}{:>10.0f}{:>10.0f}'.format(
+            scenario, len(latencies), errors, len(latencies) / elapsed,
+            percentile(latencies, 50) * 1000, percentile(latencies, 90) * 1000,
+            percentile(latencies, 99) * 1000, max(latencies or [0]) * 1000))
+
+
+def run():
+    check_fixtures()
+    redis_dir = tempfile.mkdtemp()
+    processes = [subprocess.Popen([options.redis_server, '--port', str(options.stand_in_redis_port),
+                                   '--save', '', '--appendonly', 'no', '--dir', redis_dir])]
+    try:
+        wait_for_port(options.stand_in_redis_port)
+        storage.configure(host='127.0.0.1', port=options.stand_in_redis_port, db=0)
+        codes.get_cache()
+
+        processes.append(subprocess.Popen([
+            sys.executable, __file__, 'upstream', '--fixtures=' + options.fixtures,
+            '--upstream_port={}'.format(options.upstream_port),
+            '--latency={}'.format(options.latency), '--latency_jitter={}'.format(options.latency_jitter),
+        ]))
+        app_environment = dict(os.environ, HTTP_PROXY='http://127.0.0.1:{}'.format(options.upstream_port))
+        processes.append(subprocess.Popen([
+            sys.executable, '-m', 'airparse.tornado_runner',
+            '--port={}'.format(options.app_port), '--logging=warning',
+            '--redis_host=127.0.0.1', '--redis_port={}'.format(options.stand_in_redis_port),
+            '--parse_processes={}'.format(options.parse_processes),
+        ], env=app_environment, cwd=project_root))
+        wait_for_port(options.upstream_port)
+        wait_for_port(options.app_port)
+
+        tornado.ioloop.IOLoop.instance().run_sync(run_scenarios)
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+        shutil.rmtree(redis_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    arguments = tornado.options.parse_command_line()
+    command = arguments[0] if arguments else None
+    # tornado stops parsing at the command, options following it are parsed here
+    tornado.options.parse_command_line([sys.argv[0]] + arguments[1:])
+    if command == 'record':
+        record()
+    elif command == 'upstream':
+        upstream()
+    elif command == 'run':
+        run()
+    else:
+        print(__doc__)
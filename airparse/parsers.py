@@ -3,6 +3,7 @@
 
 import re
 from datetime import datetime
+from urlparse import urlparse, parse_qs
 
 from dateutil import parser
 import redis
@@ -210,16 +211,15 @@ class VKOParser(BaseParser):
 
 class LEDParser(BaseParser):
     urls = {
-        'outbound': [
-            'http://www.pulkovoairport.ru/eng/online_serves/online_timetable/departures/',
-            'http://www.pulkovoairport.ru/eng/online_serves/online_timetable/departures/?p=2'
-        ],
-        'inbound': [
-            'http://www.pulkovoairport.ru/eng/online_serves/online_timetable/arrivals/',
-            'http://www.pulkovoairport.ru/eng/online_serves/online_timetable/arrivals/?p=2',
-        ]
+        'outbound': ['http://www.pulkovoairport.ru/eng/online_serves/online_timetable/departures/'],
+        'inbound': ['http://www.pulkovoairport.ru/eng/online_serves/online_timetable/arrivals/']
     }
 
+    def next_page(self, soup, url):
+        page = int(parse_qs(urlparse(url).query).get('p', ['1'])[0])
+        link = soup.find('a', href=re.compile(r'[?&]p={}$'.format(page + 1)))
+        return link['href'] if link else None
+
     def parse(self, soup, **defaults):
         re_airport = re.compile(r'(\w+)\s+\((\w+)\)')
         statuses = {
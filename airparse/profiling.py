@@ -0,0 +1,104 @@
+# encoding=utf-8
+
+import cProfile
+import marshal
+import pstats
+import random
+from StringIO import StringIO
+import threading
+import time
+
+
+class Profiler(object):
+    '''
+    Runs hot sections (run_async, parse, serialize) under cProfile for chosen
+    airports and for a sample of all requests, summing the results per airport
+    and section. Switched on and off at runtime, and costs one check per
+    request while off. Settings and results belong to the current process.
+
+    cProfile does not nest, so a section started inside another one in the same
+    thread (parse inside run_async) stays in the enclosing profile, and only its
+    calls and seconds are added up separately.
+    '''
+    def __init__(self):
+        self.airports = set()
+        self.sample_rate = 0.0
+        self.stats = {}
+        self.timings = {}
+        self.lock = threading.Lock()
+        self.running = threading.local()
+
+    def configure(self, airports=None, sample_rate=None):
+        if airports is not None:
+            self.airports = set(airports)
+        if sample_rate is not None:
+            self.sample_rate = min(max(sample_rate, 0.0), 1.0)
+
+    def should_profile(self, iata_code):
+        return iata_code in self.airports or (self.sample_rate > 0 and random.random() < self.sample_rate)
+
+    def profile(self, iata_code, section, func, *args, **kwargs):
+        if getattr(self.running, 'profiling', False):
+            started = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add_time(iata_code, section, time.time() - started)
+        profile = cProfile.Profile()
+        self.running.profiling = True
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            self.running.profiling = False
+            self.add(iata_code, section, profile)
+
+    def add_time(self, iata_code, section, seconds):
+        with self.lock:
+            calls, total = self.timings.get((iata_code, section), (0, 0.0))
+            self.timings[iata_code, section] = calls + 1, total + seconds
+
+    def add(self, iata_code, section, profile):
+        profile.create_stats()
+        with self.lock:
+            key = iata_code, section
+            if key in self.stats:
+                self.stats[key].add(profile)
+            else:
+                self.stats[key] = pstats.Stats(profile)
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+            self.timings = {}
+
+    def status(self):
+        with self.lock:
+            collected = [{'iata_code': iata_code, 'section': section,
+                          'calls': stats.total_calls, 'seconds': round(stats.total_tt, 3)}
+                         for (iata_code, section), stats in sorted(self.stats.items())]
+            nested = [{'iata_code': iata_code, 'section': section, 'runs': runs, 'seconds': round(seconds, 3)}
+                      for (iata_code, section), (runs, seconds) in sorted(self.timings.items())]
+        return {
+            'airports': sorted(self.airports),
+            'sample_rate': self.sample_rate,
+            'profiles': collected,
+            'nested': nested,
+        }
+
+    def dump(self, iata_code, section):
+        '''Aggregated profile in the pstats file format, None if nothing was collected'''
+        with self.lock:
+            stats = self.stats.get((iata_code, section))
+            return marshal.dumps(stats.stats) if stats else None
+
+    def report(self, iata_code, section, sort='cumulative', limit=50):
+        with self.lock:
+            stats = self.stats.get((iata_code, section))
+            if not stats:
+                return None
+            stats.stream = StringIO()
+            stats.sort_stats(sort).print_stats(limit)
+            return stats.stream.getvalue()
+
+
+profiler = Profiler()
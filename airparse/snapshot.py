@@ -0,0 +1,147 @@
+# encoding=utf-8
+
+'''
+Read-only binary copy of airports.dat which is memory-mapped instead of parsed,
+so every worker opens it instantly and shares its pages with the others.
+
+Layout, all integers little-endian:
+    header     magic, records count, lookup entries count, IATA entries count
+    records    string offsets of name, city, country, IATA and ICAO codes, latitude, longitude
+    lookup     (key string offset, record number) sorted by key, keys are lowercased names and cities
+    iata       (key string offset, record number) sorted by IATA code
+    strings    UTF-8 strings, each prefixed with its length
+'''
+
+import mmap
+import os
+import struct
+import tempfile
+
+
+MAGIC = b'APS1'
+HEADER = struct.Struct('<4sIII')
+RECORD = struct.Struct('<IIIIIdd')
+ENTRY = struct.Struct('<II')
+STRING_LENGTH = struct.Struct('<H')
+
+record_fields = 'name', 'city', 'country', 'iata_code', 'icao_code'
+
+
+def to_unicode(value):
+    return value if isinstance(value, unicode) else value.decode('utf-8')
+
+
+def lookup_key(name):
+    return to_unicode(name).lower().encode('utf-8')
+
+
+def build(airports, target):
+    '''
+    Writes a snapshot of airports, as yielded by codes.load_airports, to target file.
+    The file is replaced, not rewritten: workers keep the snapshot they have mapped.
+    '''
+    strings, string_offsets = [], {}
+    strings_size = [0]
+
+    def add_string(value):
+        value = to_unicode(value or '').encode('utf-8')
+        if value not in string_offsets:
+            string_offsets[value] = strings_size[0]
+            strings.append(STRING_LENGTH.pack(len(value)) + value)
+            strings_size[0] += STRING_LENGTH.size + len(value)
+        return string_offsets[value]
+
+    records, lookup, iata = [], {}, {}
+    for number, port in enumerate(airports):
+        records.append([add_string(port[field]) for field in record_fields] +
+                       [float(port['latitude'] or 0), float(port['longitude'] or 0)])
+        # later airports win, just like in the Redis cache
+        lookup[lookup_key(port['city'])] = number
+        lookup[lookup_key(port['name'])] = number
+        if port['iata_code']:
+            iata[to_unicode(port['iata_code']).encode('utf-8')] = number
+
+    lookup_entries = [(add_string(key), number) for key, number in sorted(lookup.items())]
+    iata_entries = [(add_string(key), number) for key, number in sorted(iata.items())]
+
+    strings_offset = (HEADER.size + RECORD.size * len(records) +
+                      ENTRY.size * (len(lookup_entries) + len(iata_entries)))
+
+    # truncating a mapped file kills whoever reads it next, so a new file is renamed over it
+    handle, temporary = tempfile.mkstemp(prefix='.airports-', dir=os.path.dirname(os.path.abspath(target)))
+    try:
+        with os.fdopen(handle, 'wb') as snapshot_file:
+            snapshot_file.write(HEADER.pack(MAGIC, len(records), len(lookup_entries), len(iata_entries)))
+            for record in records:
+                offsets, coordinates = record[:len(record_fields)], record[len(record_fields):]
+                snapshot_file.write(RECORD.pack(*[strings_offset + o for o in offsets] + coordinates))
+            for key_offset, number in lookup_entries + iata_entries:
+                snapshot_file.write(ENTRY.pack(strings_offset + key_offset, number))
+            snapshot_file.write(b''.join(strings))
+        os.chmod(temporary, 0o644)
+        os.rename(temporary, target)
+    except Exception:
+        os.remove(temporary)
+        raise
+
+
+class AirportsSnapshot(object):
+    def __init__(self, filename):
+        with open(filename, 'rb') as snapshot_file:
+            self.data = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count, self.lookup_count, self.iata_count = HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ValueError('{} is not an airports snapshot'.format(filename))
+        self.lookup_offset = HEADER.size + RECORD.size * self.count
+        self.iata_offset = self.lookup_offset + ENTRY.size * self.lookup_count
+
+    def _raw_string(self, offset):
+        length, = STRING_LENGTH.unpack_from(self.data, offset)
+        start = offset + STRING_LENGTH.size
+        return self.data[start:start + length]
+
+    def _string(self, offset):
+        return self._raw_string(offset).decode('utf-8')
+
+    def _search(self, table_offset, count, key):
+        '''Binary search over a sorted entries table, returns record number or None'''
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            key_offset, number = ENTRY.unpack_from(self.data, table_offset + ENTRY.size * middle)
+            current = self._raw_string(key_offset)
+            if current == key:
+                return number
+            if current < key:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def record(self, number):
+        values = RECORD.unpack_from(self.data, HEADER.size + RECORD.size * number)
+        port = dict(zip(record_fields, map(self._string, values[:len(record_fields)])))
+        port['latitude'], port['longitude'] = values[len(record_fields):]
+        return port
+
+    def _record_field(self, number, field):
+        if number is None:
+            return None
+        offset = RECORD.unpack_from(self.data, HEADER.size + RECORD.size * number)[record_fields.index(field)]
+        return self._string(offset)
+
+    def find_code(self, name):
+        number = self._search(self.lookup_offset, self.lookup_count, lookup_key(name))
+        return self._record_field(number, 'iata_code') or None
+
+    def find_name(self, iata_code):
+        number = self._search(self.iata_offset, self.iata_count, to_unicode(iata_code).encode('utf-8'))
+        return self._record_field(number, 'name')
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for number in xrange(self.count):
+            yield self.record(number)
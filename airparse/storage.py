@@ -0,0 +1,150 @@
+# encoding=utf-8
+
+from __future__ import print_function
+from collections import OrderedDict
+import threading
+import time
+import uuid
+
+from concurrent import futures
+import redis
+
+
+_settings = {
+    'host': 'localhost',
+    'port': 6379,
+    'db': 0,
+    'max_connections': None,
+}
+_pool = None
+
+
+def configure(**settings):
+    '''Changes Redis connection settings, drops the current pool'''
+    global _pool
+    _settings.update(settings)
+    if _pool is not None:
+        _pool.disconnect()
+    _pool = None
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = redis.ConnectionPool(**_settings)
+    return _pool
+
+
+def get_connection():
+    '''Client bound to the shared connection pool, cheap to create'''
+    return redis.StrictRedis(connection_pool=get_pool())
+
+
+class AsyncRedis(object):
+    '''
+    Runs Redis commands in a small thread pool and returns futures,
+    so Tornado coroutines can yield them without blocking the IOLoop:
+        raw = yield async_redis.get(key)
+    '''
+    def __init__(self, max_workers=4):
+        self.executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    def pipeline(self, commands, transaction=False):
+        '''Executes a list of (command_name, args...) tuples in one round trip'''
+        def execute():
+            pipe = get_connection().pipeline(transaction=transaction)
+            for command in commands:
+                getattr(pipe, command[0])(*command[1:])
+            return pipe.execute()
+        return self.executor.submit(execute)
+
+    def __getattr__(self, item):
+        def command(*args, **kwargs):
+            return self.executor.submit(getattr(get_connection(), item), *args, **kwargs)
+        return command
+
+
+async_redis = AsyncRedis()
+
+
+class LocalCache(object):
+    '''
+    Bounded in-process LRU cache in front of Redis, entries expire on their own.
+    Keys are (iata_code, kind) tuples, so everything cached for an airport
+    can be dropped at once.
+    '''
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[1] < time.time():
+                return None
+            self.entries[key] = entry
+            return entry[0]
+
+    def set(self, key, value, timeout):
+        if timeout is None or timeout <= 0:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value, time.time() + timeout
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, iata_code):
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == iata_code]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+local_cache = LocalCache()
+
+INVALIDATION_CHANNEL = 'airport_invalidate'
+worker_id = uuid.uuid4().hex
+
+
+def invalidation_message(iata_code):
+    return '{} {}'.format(worker_id, iata_code)
+
+
+def publish_invalidation(iata_code):
+    '''Tells other workers to drop their local copies of the airport timetable'''
+    get_connection().publish(INVALIDATION_CHANNEL, invalidation_message(iata_code))
+
+
+def listen_for_invalidations():
+    while True:
+        try:
+            pubsub = get_connection().pubsub()
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            for message in pubsub.listen():
+                if message['type'] != 'message':
+                    continue
+                try:
+                    sender, iata_code = message['data'].split(' ', 1)
+                except (AttributeError, ValueError):
+                    # a stray publish must not stop invalidations for good
+                    print('malformed invalidation message: {!r}'.format(message['data']))
+                    continue
+                if sender != worker_id:
+                    local_cache.invalidate(iata_code)
+        except redis.ConnectionError as e:
+            print('invalidation listener lost Redis: {}'.format(e))
+            # whatever was published meanwhile is lost, start from scratch
+            local_cache.clear()
+            time.sleep(1)
+
+
+def start_invalidation_listener():
+    listener = threading.Thread(target=listen_for_invalidations, name='cache-invalidation')
+    listener.daemon = True
+    listener.start()
+    return listener
@@ -17,13 +17,33 @@ import tornado.gen
 import functools
 import os
 
+from concurrent import futures
+from dateutil import parser as date_parser
+
 from parsers import registry
+import codes
+from profiling import profiler
+from engine import Timetable, FlightEncoder, configure_parsing_processes, content_types, available_formats, JSON, \
+    refresh_policy
+import storage
+from airdelay import export
 
 
 define("port", default=8000, help="run on the given port", type=int)
 define("address", default='127.0.0.1', help="run on the given host address", type=str)
-static_root = os.path.join(os.path.dirname(__file__), '..', 'static')
-template_root = os.path.join(os.path.dirname(__file__), '..', 'templates')
+define("redis_host", default='localhost', help="Redis host", type=str)
+define("redis_port", default=6379, help="Redis port", type=int)
+define("redis_db", default=0, help="Redis database number", type=int)
+define("redis_max_connections", default=None, help="Redis connection pool size", type=int)
+define("parse_processes", default=0, help="number of processes parsing HTML, 0 parses in threads", type=int)
+define("cache_min_timeout", default=60, help="shortest adaptive timetable cache timeout, seconds", type=int)
+define("cache_max_timeout", default=900, help="longest adaptive timetable cache timeout, seconds", type=int)
+define("local_cache_size", default=256, help="timetables and responses kept in process memory", type=int)
+define("admin_token", default=None, help="token for /admin/ endpoints, they are off without it", type=str)
+project_root = os.path.join(os.path.dirname(__file__), '..')
+static_root = os.path.join(project_root, 'static')
+template_root = os.path.join(project_root, 'templates')
+export_executor = futures.ThreadPoolExecutor(max_workers=2)
 
 
 class HomeHandler(tornado.web.RequestHandler):
@@ -34,32 +54,275 @@ class HomeHandler(tornado.web.RequestHandler):
 class AirportsHandler(tornado.web.RequestHandler):
     @tornado.gen.coroutine
     def get(self, iata_code, _type=None):
-        client = tornado.httpclient.AsyncHTTPClient()
-        try:
-            parser = registry.initialize(iata_code)
-        except TypeError:
+        if iata_code not in registry:
             self.set_status(404)
             self.write({
                 'status': 'error',
                 'message': 'Airport {} not found'.format(iata_code)
             })
             self.finish()
+            return
+
+        fmt = self.get_format()
+        if fmt is None:
+            self.set_status(406)
+            self.write({
+                'status': 'error',
+                'message': 'Supported formats: {}'.format(', '.join(available_formats()))
+            })
+            self.finish()
+            return
+
+        if self.get_argument('stream', None):
+            yield self.stream_timetable(iata_code)
+            return
+
+        # most hits are served from local memory, the rest without blocking the IOLoop on Redis
+        response = storage.local_cache.get((iata_code, fmt))
+        if response is None:
+            key = Timetable.cache_key_for(iata_code)
+            cached, timeout = yield storage.async_redis.pipeline([('get', key), ('ttl', key)])
+            if cached:
+                storage.local_cache.set((iata_code, JSON), cached, timeout)
+            if cached and fmt == JSON:
+                response = cached
+            else:
+                if cached:
+                    records = Timetable(iata_code)
+                    records.set_from_json(cached)
+                    profiled = profiler.should_profile(iata_code)
+                else:
+                    parser = registry.initialize(iata_code)
+                    records = yield parser.run_async()
+                    # partial, failed or losing refreshes are not what Redis holds, they are not kept
+                    timeout = records.cache_timeout if records.saved else None
+                    profiled = parser.profiled
+                if profiled:
+                    response = profiler.profile(iata_code, 'serialize', records.encode, fmt)
+                else:
+                    response = records.encode(fmt)
+            storage.local_cache.set((iata_code, fmt), response, timeout)
+
+        self.write(response)
+        self.set_header('Content-Type', content_types[fmt])
+        self.finish()
+
+    def get_format(self):
+        '''Picks output format from ?format= or Accept header, None if it is not supported'''
+        fmt = self.get_argument('format', None)
+        if fmt is None:
+            accept = self.request.headers.get('Accept', '')
+            fmt = next((f for f, content_type in content_types.items() if content_type in accept), JSON)
+        return fmt if fmt in available_formats() else None
+
+    @tornado.gen.coroutine
+    def stream_timetable(self, iata_code):
+        '''
+        Writes one JSON document per line as pages get parsed. Every line holds
+        only the new flights and "partial": true, the last one has "partial": false.
+        '''
+        self.set_header('Content-Type', 'application/x-ndjson')
+
+        cached = yield storage.async_redis.get(Timetable.cache_key_for(iata_code))
+        if cached:
+            self.write_chunk(dict(json.loads(cached), partial=False))
         else:
-            records = yield parser.run_async()
-            self.write(records.to_json())
+            ioloop = tornado.ioloop.IOLoop.instance()
+
+            def on_page(flights):
+                ioloop.add_callback(self.write_chunk, {'iata_code': iata_code, 'partial': True, 'flights': flights})
+
+            parser = registry.initialize(iata_code)
+            records = yield parser.run_async(on_page)
+            # a stale timetable replaces whatever pages were streamed before it
+            self.write_chunk(dict(records.to_dict(), partial=False, flights=records.flights if records.stale else []))
+
+        self.finish()
+
+    def write_chunk(self, data):
+        if self._finished:
+            return
+        self.write(json.dumps(data, cls=FlightEncoder) + '\n')
+        self.flush()
+
 
-            self.set_header('Content-Type', 'application/json')
+class ExportHandler(tornado.web.RequestHandler):
+    '''
+    Streams flight history: /export/?airport=SVO&start=2013-08-01&end=2013-09-01&format=ndjson&gzip=1
+    Chunks are read from the database in a thread and flushed one by one.
+    '''
+    @tornado.gen.coroutine
+    def get(self):
+        fmt = self.get_argument('format', export.CSV)
+        compress = self.get_argument('gzip', '').lower() not in ('', '0', 'false', 'no')
+        try:
+            start, end = [date_parser.parse(self.get_argument(arg)) if self.get_argument(arg, None) else None
+                          for arg in ('start', 'end')]
+            blocks = export.export(self.get_argument('airport', None), start, end, fmt, compress)
+        except ValueError as e:
+            self.set_status(400)
+            self.write({'status': 'error', 'message': unicode(e)})
             self.finish()
+            return
+
+        extension = 'csv' if fmt == export.CSV else 'json'
+        self.set_header('Content-Type', 'text/csv' if fmt == export.CSV else 'application/x-ndjson')
+        self.set_header('Content-Disposition', 'attachment; filename=flights.{}{}'.format(
+            extension, '.gz' if compress else ''))
+
+        while True:
+            block = yield export_executor.submit(next, blocks, None)
+            if block is None:
+                break
+            self.write(block)
+            yield tornado.gen.Task(self.flush)
+        self.finish()
+
+
+class GeoHandler(tornado.web.RequestHandler):
+    def get_point(self):
+        '''(lat, lon) from the query, None if they are missing or broken'''
+        try:
+            return float(self.get_argument('lat')), float(self.get_argument('lon'))
+        except (ValueError, tornado.web.MissingArgumentError):
+            return None
+
+    def write_error_message(self, message):
+        self.set_status(400)
+        self.write({
+            'status': 'error',
+            'message': message
+        })
+        self.finish()
+
+
+class NearestAirportHandler(GeoHandler):
+    def get(self):
+        point = self.get_point()
+        if point is None:
+            return self.write_error_message('lat and lon are required')
+        nearest = codes.get_spatial_index().nearest(*point)
+        if nearest is None:
+            return self.write_error_message('no airports with coordinates are known')
+        distance, airport = nearest
+        self.write(dict(airport, distance_km=round(distance, 1)))
+
+
+class RegionHandler(GeoHandler):
+    '''Current delays at every supported airport within ?radius= km of ?lat= and ?lon='''
+    @tornado.gen.coroutine
+    def get(self):
+        point = self.get_point()
+        try:
+            radius = float(self.get_argument('radius', 100))
+        except ValueError:
+            radius = None
+        if point is None or radius is None:
+            self.write_error_message('lat, lon and radius (km) should be numbers')
+            return
+
+        airports = [(distance, airport) for distance, airport in codes.get_spatial_index().within(*point, km=radius)
+                    if airport['iata_code'] in registry]
+        timetables = yield [registry.initialize(airport['iata_code']).run_async() for _, airport in airports]
+
+        summaries = []
+        for (distance, airport), records in zip(airports, timetables):
+            summaries.append(dict(records.delay_summary(), iata_code=airport['iata_code'], name=airport['name'],
+                                  distance_km=round(distance, 1), stale=records.stale,
+                                  incomplete=records.incomplete))
+        total = {
+            key: sum(summary[key] for summary in summaries) for key in ('flights', 'delayed', 'cancelled')
+        }
+        self.write({
+            'latitude': point[0],
+            'longitude': point[1],
+            'radius_km': radius,
+            'total': total,
+            'airports': summaries,
+        })
+
+
+class AdminHandler(tornado.web.RequestHandler):
+    def prepare(self):
+        token = self.request.headers.get('X-Admin-Token') or self.get_argument('token', None)
+        if not options.admin_token or token != options.admin_token:
+            raise tornado.web.HTTPError(403)
+
+
+class ProfilingHandler(AdminHandler):
+    '''
+    GET shows settings and collected profiles of this process,
+    POST airports=SVO,DME&sample_rate=0.01 switches profiling on, both empty switch it off,
+    DELETE drops collected profiles.
+    '''
+    def get(self):
+        self.write(profiler.status())
+
+    def post(self):
+        airports = self.get_argument('airports', None)
+        sample_rate = self.get_argument('sample_rate', None)
+        try:
+            profiler.configure(
+                airports=None if airports is None else [a.strip() for a in airports.split(',') if a.strip()],
+                sample_rate=None if sample_rate is None else float(sample_rate or 0)
+            )
+        except ValueError:
+            self.set_status(400)
+            self.write({
+                'status': 'error',
+                'message': 'sample_rate should be a number between 0 and 1'
+            })
+            return
+        self.write(profiler.status())
+
+    def delete(self):
+        profiler.reset()
+        self.write(profiler.status())
+
+
+class ProfileDownloadHandler(AdminHandler):
+    '''Aggregated profile as a pstats file (.prof) or a text report (.txt)'''
+    def get(self, iata_code, section, extension):
+        if extension == 'prof':
+            content = profiler.dump(iata_code, section)
+            content_type = 'application/octet-stream'
+            self.set_header('Content-Disposition', 'attachment; filename={}-{}.prof'.format(iata_code, section))
+        else:
+            try:
+                content = profiler.report(iata_code, section, sort=self.get_argument('sort', 'cumulative'))
+            except KeyError:
+                raise tornado.web.HTTPError(400, 'unknown sort key')
+            content_type = 'text/plain'
+        if content is None:
+            raise tornado.web.HTTPError(404)
+        self.set_header('Content-Type', content_type)
+        self.write(content)
 
 
 app = tornado.web.Application(handlers=[
     (r'/airports/(.+?)/(?:(.+?)/)?$', AirportsHandler),
+    (r'/export/$', ExportHandler),
+    (r'/regions/$', RegionHandler),
+    (r'/nearest/$', NearestAirportHandler),
+    (r'/admin/profiling/$', ProfilingHandler),
+    (r'/admin/profiling/(\w+)/(\w+)\.(prof|txt)$', ProfileDownloadHandler),
     (r'/', HomeHandler),
 ], template_path=template_root, static_path=static_root, debug=True)
 
 
 if __name__ == '__main__':
     tornado.options.parse_command_line()
+    storage.configure(host=options.redis_host, port=options.redis_port, db=options.redis_db,
+                      max_connections=options.redis_max_connections)
+    configure_parsing_processes(options.parse_processes)
+    refresh_policy.min_timeout = options.cache_min_timeout
+    refresh_policy.max_timeout = options.cache_max_timeout
+    storage.local_cache.max_size = options.local_cache_size
+    storage.start_invalidation_listener()
+    codes.get_spatial_index()
+    # handlers build Timetables and parsers on the IOLoop, their name lookups must not go to Redis
+    for iata_code in registry:
+        codes.find_airport_name(iata_code)
     http_server = tornado.httpserver.HTTPServer(app)
     http_server.listen(options.port, options.address)
     tornado.ioloop.IOLoop.instance().start()
\ No newline at end of file
@@ -4,4 +4,8 @@ from airparse import codes
 
 
 def load_airports():
-    codes.reload_airports_cache()
\ No newline at end of file
+    codes.reload_airports_cache()
+
+
+def build_airports_snapshot():
+    codes.build_airports_snapshot()